@@ -0,0 +1,1686 @@
+#!/usr/bin/env python3
+"""
+Push-to-Talk Dictation using Whisper
+Hold Right Command key to record and transcribe speech
+
+The application itself. Start it through dictation.py, which takes the
+single-instance lock before this module's imports run.
+"""
+
+# mlx_whisper/MLX and sounddevice are imported where they're first used (see
+# load_model): MLX alone takes seconds to import and would hold up the menu bar
+import numpy as np
+import threading
+import os
+import subprocess
+import rumps
+import logging
+import datetime
+import queue
+import collections
+import time
+import json
+import mmap
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from CoreFoundation import (
+    CFMachPortCreateRunLoopSource,
+    CFRunLoopGetCurrent,
+    CFRunLoopAddSource,
+    kCFRunLoopDefaultMode,
+)
+from Quartz import (
+    CGEventMaskBit,
+    kCGEventKeyDown,
+    kCGEventKeyUp,
+    kCGEventFlagsChanged,
+    CGEventTapCreate,
+    kCGSessionEventTap,
+    kCGHeadInsertEventTap,
+    CGEventTapEnable,
+    kCGEventTapOptionDefault,
+    CGEventSourceFlagsState,
+    kCGEventSourceStateHIDSystemState,
+    kCGEventFlagMaskCommand,
+    CGEventCreateKeyboardEvent,
+    CGEventKeyboardSetUnicodeString,
+    CGEventPost,
+    kCGHIDEventTap,
+    CGEventGetFlags,
+    CGEventSetFlags,
+)
+
+# Setup logging - INFO until DictationApp applies the "log_level" preference (see apply_log_level)
+logging.basicConfig(
+    filename=os.path.expanduser('~/Library/Logs/Dictation.log'),
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+_DEBUG_LOGGING = False  # Lets hot paths skip building debug messages (kept in sync by apply_log_level)
+
+PREFERENCES_FILE = os.path.expanduser('~/Library/Application Support/Dictation/preferences.json')
+
+def validate_model(model_name):
+    """
+    Validate model name against VALID_MODELS list.
+
+    Returns:
+        str: The validated model name, or DEFAULT_MODEL if invalid
+    """
+    return model_name if model_name in VALID_MODELS else DEFAULT_MODEL
+
+def load_preferences():
+    """Load preferences from JSON file, return defaults if missing/corrupt"""
+    defaults = {"model": DEFAULT_MODEL}
+
+    try:
+        if not os.path.exists(PREFERENCES_FILE):
+            logging.info("No preferences file found, using defaults")
+            return defaults
+
+        with open(PREFERENCES_FILE, 'r') as f:
+            prefs = json.load(f)
+
+        # Validate model name
+        if "model" in prefs:
+            prefs["model"] = validate_model(prefs["model"])
+        else:
+            prefs["model"] = defaults["model"]
+
+        # Drop a malformed quantize flag rather than guessing what it meant
+        if not isinstance(prefs.get("quantize", False), bool):
+            del prefs["quantize"]
+
+        # Same for a log level logging doesn't know (e.g. "DEBUG", "INFO")
+        if "log_level" in prefs:
+            level = prefs["log_level"]
+            if isinstance(level, str) and isinstance(logging.getLevelName(level.upper()), int):
+                prefs["log_level"] = level.upper()
+            else:
+                del prefs["log_level"]
+
+        logging.info(f"Loaded preferences: {prefs}")
+        return prefs
+
+    except (json.JSONDecodeError, IOError) as e:
+        logging.warning(f"Failed to load preferences: {e}, using defaults")
+        return defaults
+
+def apply_log_level(level_name=None):
+    """Set the root log level from the "log_level" preference (INFO if unset)"""
+    global _DEBUG_LOGGING
+    logging.getLogger().setLevel(level_name or logging.INFO)
+    _DEBUG_LOGGING = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+def save_preferences(prefs_dict):
+    """
+    Save preferences atomically to avoid corruption.
+
+    Uses atomic file operations: write to temp file, then rename.
+    This prevents corruption if the app crashes during save.
+    """
+    temp_file = None
+    try:
+        # Create directory if needed
+        os.makedirs(os.path.dirname(PREFERENCES_FILE), exist_ok=True)
+
+        # Write to temp file first, then rename (atomic on macOS)
+        temp_file = PREFERENCES_FILE + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(prefs_dict, f, indent=2)
+
+        os.rename(temp_file, PREFERENCES_FILE)  # Atomic operation
+        logging.info(f"Saved preferences: {prefs_dict}")
+
+    except Exception as e:
+        logging.error(f"Failed to save preferences: {e}")
+        # Clean up temp file if it exists
+        if temp_file and os.path.exists(temp_file):
+            try:
+                os.unlink(temp_file)
+            except:
+                pass
+
+
+# Configuration
+SAMPLE_RATE = 16000
+CHANNELS = 1
+kVK_RightCommand = 0x36  # Virtual key code for Right Command
+kCGEventFlagMaskCommandLeft = 0x0008  # Left Command key bit in event flags (NX_DEVICELCMDKEYMASK - PyObjC doesn't export it)
+_KEY_EVENT_TYPES = frozenset((kCGEventKeyDown, kCGEventKeyUp))  # Events whose flags are stripped during typing
+_EVENT_MASK = (  # Events the keyboard tap listens for
+    CGEventMaskBit(kCGEventKeyDown) |
+    CGEventMaskBit(kCGEventKeyUp) |
+    CGEventMaskBit(kCGEventFlagsChanged)
+)
+TRANSCRIPTION_TIMEOUT = 120  # seconds - max time for transcription
+TRANSCRIPT_LOG_THRESHOLD = 30  # seconds - log transcriptions longer than this
+MAX_TRANSCRIPTION_RETRIES = 2  # number of retries for failed transcriptions
+VALID_MODELS = ["tiny", "base", "small", "medium", "large"]  # Available Whisper models
+DEFAULT_MODEL = "base"  # Short push-to-talk utterances: base is ~2x faster than small at near-identical accuracy
+USE_FP16 = True  # Apple GPU runs fp16 natively - half the activation bandwidth of fp32
+QUANTIZE_BY_DEFAULT = ("tiny", "base", "small")  # Models quantized at load unless the "quantize" preference says otherwise
+QUANTIZE_BITS = 8  # Linear layer weights: halves the bytes each decoder step reads vs fp16
+QUANTIZE_GROUP_SIZE = 64
+LOW_CONFIDENCE_LOGPROB = -1.0  # Long transcriptions averaging below this are re-run with the next larger model
+
+# MLX Whisper repos (English-only for speed, large uses turbo)
+MLX_REPOS = {
+    "tiny": "mlx-community/whisper-tiny.en-mlx",
+    "base": "mlx-community/whisper-base.en-mlx",
+    "small": "mlx-community/whisper-small.en-mlx",
+    "medium": "mlx-community/whisper-medium.en-mlx",
+    "large": "mlx-community/whisper-large-v3-turbo",
+}
+SEGMENT_SECONDS = 28  # seconds - long recordings are transcribed in segments of about this length while still recording
+SEGMENT_FRAMES = SEGMENT_SECONDS * SAMPLE_RATE
+SEGMENT_CUT_SEARCH_SECONDS = 2  # seconds - a segment ends at the quietest point this close to its boundary (so segments stay within Whisper's 30s window)
+SEGMENT_CUT_WINDOW = SAMPLE_RATE // 50  # frames (20ms) - energy is compared over windows of this size when picking the cut
+FRAME_BYTES = 4 * CHANNELS  # float32 samples - the raw stream delivers bytes, the ring is indexed in frames
+RING_FRAMES = 4 * SEGMENT_FRAMES  # Recording ring size - segments are copied out every SEGMENT_SECONDS, so it only holds the unsent tail
+MIN_RECORDING_SECONDS = 0.25  # seconds - shorter recordings are accidental taps and aren't transcribed
+SILENCE_RMS_THRESHOLD = 0.005  # RMS (full scale = 1.0) below which a recording is treated as silence
+BATCH_GAP_SECONDS = 0.5  # seconds - silence inserted between chunks batched into one transcription
+COMMAND_RELEASE_TIMEOUT = 0.2  # seconds - max wait for Command release before deferring typed text
+MAX_UNICODE_EVENT_LENGTH = 20  # UTF-16 code units - CGEventKeyboardSetUnicodeString limit per key event
+OPEN_COMMAND_TIMEOUT = 2.0  # seconds - max wait for `open` when showing the transcript log
+STREAM_CLOSE_TIMEOUT = 2.0  # seconds - timeout for stream close before abandoning (conservative for slow systems)
+MAX_ABANDONED_STREAMS = 10  # Force restart after this many leaked streams
+
+# Global state (queue-based architecture)
+command_queue = collections.deque()  # Commands for state_manager - use post_command()/get_command()
+command_signal = threading.Event()  # Set when command_queue gains an item
+transcription_queue = queue.Queue()  # (chunk_id, audio, long_recording) waiting for transcription_worker
+type_queue = queue.SimpleQueue()  # (chunk_id, text) in typing order, consumed by typing_worker
+typing_resume = threading.Event()  # Set on Right Command release so a deferred typing_worker retries
+recording_ring = None  # Capture buffer, allocated on first recording (written only by audio_callback)
+recording_ring_bytes = None  # Byte view of recording_ring - what audio_callback copies into
+recording_frames = 0  # Frames captured in the current recording - the ring's write index, modulo RING_FRAMES
+audio_capture_enabled = threading.Event()  # Safety net: disable callbacks before closing
+audio_capture_enabled.clear()  # Start disabled (stream will be created on demand)
+_model_paths = {}  # Model name -> local snapshot directory (see resolve_model_path)
+model_ready = threading.Event()  # Set once load_model finishes (cleared during a switch) - transcription waits on it
+right_command_pressed = False
+_last_transition = None  # Last COMMAND_DOWN/COMMAND_UP the event tap queued
+typing_in_progress = False  # Flag to block Right Command during typing
+_typing_lock = threading.Lock()  # Makes type_text's Command check + typing_in_progress set atomic w.r.t. the event tap
+command_released_event = threading.Event()  # Set while Right Command is up (maintained by key_event_callback)
+command_released_event.set()  # Start released
+current_model = DEFAULT_MODEL
+quantize_preference = None  # Saved "quantize" preference (None = QUANTIZE_BY_DEFAULT decides)
+_quantized_model = None  # Weak reference to the model prepare_model last quantized (never keeps its weights alive)
+_model_lock = threading.Lock()  # Serializes ModelHolder use: prepare_model and every transcribe() (see transcribe_with_model)
+app_instance = None  # Reference to DictationApp instance for updating icon
+abandoned_streams = 0  # Track leaked streams from deadlocked close() calls
+creation_failures = 0  # Track failed stream creations (separate from actual leaks)
+close_thread_counter = 0  # Counter for naming close threads
+
+# Menu bar icons
+_ICON_MIC = "🎤"  # Ready / recording
+_ICON_THINKING = "💭"  # Transcribing
+_ICON_PAUSED = "⏸️"  # Text waiting for Command release
+_current_icon = _ICON_MIC  # Title DictationApp starts with
+_icon_lock = threading.Lock()  # set_icon runs on both state_manager and typing_worker
+
+# Thread pool executor for running transcription with timeout
+# Use max_workers=2 to allow one timeout to run while a new transcription starts.
+# Not a parallelism knob: MLX runs every call on the one GPU, and ModelHolder
+# caches a single model, so concurrent transcriptions would only contend -
+# throughput comes from transcription_worker batching chunks instead.
+transcription_executor = ThreadPoolExecutor(max_workers=2)
+
+def is_command_physically_held():
+    """
+    Check if Right Command key is physically pressed RIGHT NOW.
+
+    This queries the actual hardware state from the HID system, not our event queue.
+    Returns True if Right Command is currently held, False otherwise.
+    """
+    try:
+        # Get current modifier flags from HID system
+        flags = CGEventSourceFlagsState(kCGEventSourceStateHIDSystemState)
+    except Exception as e:
+        logging.error(f"Error checking physical Command state: {e}")
+        return False  # Assume not held on error
+
+    # Check if any Command key is pressed
+    if not (flags & kCGEventFlagMaskCommand):
+        return False
+
+    # Check if it's Right Command (not Left)
+    # If Left Command flag is NOT set, then it must be Right Command
+    return not (flags & kCGEventFlagMaskCommandLeft)
+
+def load_model(model_name=None):
+    """
+    Load the Whisper model into memory (runs on a background thread).
+
+    The hotkey works while this runs: recordings queue up and
+    transcription_worker waits on model_ready before transcribing them.
+    model_ready is set even if loading fails, so transcribe() then
+    retries the load itself instead of the worker waiting forever.
+    """
+    model_ready.clear()
+    try:
+        _preload_model(model_name)
+    finally:
+        model_ready.set()
+
+def _preload_model(model_name):
+    """
+    Load, quantize and warm up the model for load_model.
+
+    mlx_whisper would otherwise load the weights inside the first transcribe()
+    call, adding seconds to the user's first dictation. Loading through
+    ModelHolder (mlx_whisper's own single-model cache) with the dtype
+    transcribe() uses means that call finds the model already resident.
+
+    The cached model's Linear layers are quantized in place (see
+    prepare_model), so transcribe() runs the quantized weights. A
+    one-second silent transcription then warms up the rest of the pipeline.
+    """
+    global current_model
+    if model_name:
+        current_model = model_name
+    logging.info(f"Loading {current_model} model (MLX repo: {MLX_REPOS[current_model]})")
+
+    try:
+        path = resolve_model_path(current_model)
+    except Exception as e:
+        # Not fatal - transcribe() will try again on first use
+        logging.error(f"Failed to fetch {current_model} model ({type(e).__name__}): {e}")
+        return
+
+    # Start reading the weights now so the disk works while MLX imports
+    prefetched = prefetch_model_files(path)
+
+    try:
+        start_time = time.time()
+        # First import of MLX happens here, off the main thread, after the menu bar is up
+        with _model_lock:
+            prepare_model(current_model)
+        logging.info(f"Model loaded successfully ({time.time() - start_time:.1f}s)")
+    except Exception as e:
+        # Not fatal - transcribe() will try loading again on first use
+        logging.error(f"Failed to preload {current_model} model ({type(e).__name__}): {e}")
+        return
+    finally:
+        for mapping in prefetched:
+            mapping.close()
+
+    # Warm up: the first transcribe() also builds the Metal kernels and mel
+    # filterbank - pay for that here rather than in the user's first dictation
+    try:
+        start_time = time.time()
+        transcribe_with_model(np.zeros(SAMPLE_RATE, dtype=np.float32), current_model)
+
+        # Batched chunks are split by word timestamps, whose alignment DTW is
+        # numba-compiled on first call. Silence yields no words to align, so
+        # compile it directly (same float32 2-D signature find_alignment uses)
+        from mlx_whisper.timing import dtw
+        dtw(np.zeros((2, 2), dtype=np.float32))
+        logging.info(f"Model warmed up ({time.time() - start_time:.1f}s)")
+    except Exception as e:
+        logging.warning(f"Model warm-up failed ({type(e).__name__}): {e}")
+
+def prefetch_model_files(path):
+    """
+    Ask the kernel to start reading a model's weight files into the page cache.
+
+    madvise(MADV_WILLNEED) returns immediately and the reads run in the
+    background, so whatever runs next (the MLX import) overlaps the disk
+    I/O. The caller closes the returned mappings once the model is loaded.
+
+    Returns:
+        list: Open mmap objects (empty if nothing could be prefetched)
+    """
+    mappings = []
+    for name in os.listdir(path):
+        if not name.endswith(('.safetensors', '.npz')):
+            continue
+        try:
+            with open(os.path.join(path, name), 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            mapping.madvise(mmap.MADV_WILLNEED)
+            mappings.append(mapping)
+        except (OSError, ValueError) as e:
+            # Only an optimization - mx.load reads the file either way
+            logging.debug(f"Could not prefetch {name}: {e}")
+    return mappings
+
+def resolve_model_path(model_name, download=True):
+    """
+    Local snapshot directory for a model, downloading it the first time.
+
+    Given a repo ID, mlx_whisper calls snapshot_download on every model load,
+    which asks the Hugging Face Hub for the latest revision over the network
+    even when the weights are cached. Handing it the local directory skips
+    that; after the first lookup this is a dict hit.
+
+    Returns None instead of downloading when download is False.
+    """
+    path = _model_paths.get(model_name)
+    if path is None:
+        from huggingface_hub import snapshot_download  # Installed with mlx_whisper
+
+        repo = MLX_REPOS[model_name]
+        try:
+            path = snapshot_download(repo_id=repo, local_files_only=True)
+        except Exception:
+            if not download:
+                return None
+            logging.info(f"{model_name} model not downloaded yet - fetching {repo}")
+            path = snapshot_download(repo_id=repo)
+        _model_paths[model_name] = path
+    return path
+
+def should_quantize(model_name):
+    """Whether to quantize this model at load: the saved preference, else QUANTIZE_BY_DEFAULT"""
+    if quantize_preference is not None:
+        return quantize_preference
+    return model_name in QUANTIZE_BY_DEFAULT
+
+def prepare_model(model_name):
+    """
+    Make mlx_whisper's ModelHolder hold this model, quantized if should_quantize says so.
+
+    ModelHolder caches a single model, so a transcribe() with another model
+    (or switching back after one) reloads the weights at full precision.
+    Going through here before every transcribe() quantizes whatever it
+    loaded; for the model already held it's just a cache lookup.
+
+    Call with _model_lock held.
+
+    Returns:
+        str: The model's local path, for transcribe(path_or_hf_repo=...)
+    """
+    global _quantized_model
+    import mlx.core as mx  # Already loaded by load_model - just a sys.modules lookup
+    import mlx.nn as nn
+    from mlx_whisper.transcribe import ModelHolder
+
+    path = resolve_model_path(model_name)
+    # Same path and dtype transcribe() will use (fp16=USE_FP16), or it would load a second copy
+    model = ModelHolder.get_model(path, mx.float16 if USE_FP16 else mx.float32)
+    if (_quantized_model is None or _quantized_model() is not model) and should_quantize(model_name):
+        # Only full-precision Linear layers match, so re-quantizing a model is a no-op
+        nn.quantize(
+            model,
+            group_size=QUANTIZE_GROUP_SIZE,
+            bits=QUANTIZE_BITS,
+            class_predicate=lambda _, module: isinstance(module, nn.Linear),
+        )
+        mx.eval(model.parameters())  # Quantize now, not lazily inside the next transcription
+        _quantized_model = weakref.ref(model)
+        logging.info(f"Quantized {model_name} model to {QUANTIZE_BITS}-bit")
+    return path
+
+def transcribe_with_model(audio, model_name, **decode_options):
+    """
+    mlx_whisper.transcribe() with the given model, prepared by prepare_model.
+
+    ModelHolder is one unsynchronized class-level cache: a model switch's
+    load and warm-up racing an in-flight transcription would reload each
+    other's model (unquantized) and run MLX on both at once. Holding
+    _model_lock across prepare and transcribe runs them one at a time.
+    """
+    import mlx_whisper  # Already loaded by load_model - just a sys.modules lookup
+
+    with _model_lock:
+        path = prepare_model(model_name)
+        return mlx_whisper.transcribe(audio, path_or_hf_repo=path, fp16=USE_FP16, **decode_options)
+
+def exit_now(status):
+    """
+    Exit immediately, skipping interpreter teardown (safe from any thread).
+
+    Nothing needs cleaning up: the kernel releases the single-instance flock
+    and the audio device when the process dies. A normal shutdown would run
+    finalizers for MLX and for any stream abandoned mid-deadlock instead,
+    and the latter can hang the exit.
+    """
+    logging.info(f"Exiting (status {status})")
+    logging.shutdown()  # Flush the log - os._exit skips it
+    os._exit(status)
+
+def set_icon(icon):
+    """
+    Update the menu bar icon, skipping the Cocoa round-trip if it's unchanged.
+
+    Rapid press/release cycles set the same icon repeatedly; each rumps title
+    assignment marshals a fresh NSString through setTitle_.
+    """
+    global _current_icon
+    with _icon_lock:  # Check and set together, or a stale icon can win the race
+        if app_instance and icon != _current_icon:
+            app_instance.title = icon
+            _current_icon = icon
+
+def close_stream_with_timeout(stream, timeout=STREAM_CLOSE_TIMEOUT):
+    """
+    Attempt to close an audio stream with a timeout.
+
+    PortAudio's close() can deadlock when the callback thread is stuck.
+    This wrapper detects the deadlock and abandons the stream to prevent
+    the app from hanging forever.
+
+    Resource leak on timeout (per deadlock):
+    - 1 Python daemon thread (blocked in C code, ~1-8MB stack)
+    - 1 PortAudio callback thread (~512KB + RT priority)
+    - 1 CoreAudio audio unit instance + file descriptors
+    - ~1-2MB memory total per leak
+
+    After 10 leaks, the app forces restart to prevent system audio degradation.
+
+    Returns:
+        True if stream closed successfully
+        False if close() deadlocked (stream abandoned, resources leaked)
+    """
+    global abandoned_streams, close_thread_counter
+
+    close_done = threading.Event()
+    close_thread_counter += 1
+    thread_name = f"StreamClose-{close_thread_counter}"
+
+    def try_close():
+        try:
+            stream.close()  # Hangs here on deadlock (no exception thrown)
+        except Exception as e:
+            # Legitimate errors (device disconnected, etc.) - not deadlocks
+            logging.error(f"Close error (not deadlock): {e}")
+        finally:
+            # Always set flag - either close() returned or raised exception
+            # If deadlock occurs, this line never executes (thread stuck in C)
+            close_done.set()
+
+    # Start close in background thread
+    threading.Thread(target=try_close, daemon=True, name=thread_name).start()
+
+    # Wait for close to complete (or timeout)
+    if close_done.wait(timeout=timeout):
+        logging.debug(f"Stream closed successfully within {timeout}s")
+        return True
+    else:
+        abandoned_streams += 1
+        logging.error(
+            f"stream.close() deadlocked after {timeout}s - "
+            f"abandoning stream (total leaks: {abandoned_streams})"
+        )
+
+        # Update menu bar if app is running
+        if app_instance:
+            try:
+                # Create and add leak counter on first leak (cleaner UX - hidden until needed)
+                # Double-check it wasn't already created by another thread (defensive)
+                if app_instance.leaked_streams_item is None:
+                    app_instance.leaked_streams_item = rumps.MenuItem(
+                        f"⚠️ Leaked streams: {abandoned_streams}",
+                        callback=None
+                    )
+                    # Verify still None after creation (race condition check)
+                    # If another thread created it, we'll just update below
+                    if app_instance.leaked_streams_item is not None:
+                        # Insert after separator (index 2: after "Status" at 0, separator at 1)
+                        app_instance.menu.insert(2, app_instance.leaked_streams_item)
+                        logging.info("Added leak counter to menu (first leak detected)")
+
+                # Update counter (either just created or already exists)
+                if app_instance.leaked_streams_item is not None:
+                    app_instance.leaked_streams_item.title = f"⚠️ Leaked streams: {abandoned_streams}"
+            except Exception as e:
+                # Log specific error type for easier debugging
+                logging.warning(f"Failed to update leak counter menu ({type(e).__name__}): {e}")
+
+        # Alert user if leaks accumulate
+        if abandoned_streams == 5:
+            rumps.notification(
+                title="Dictation - Resource Warning",
+                subtitle=f"{abandoned_streams} audio streams leaked",
+                message="Recording still works, but app will auto-restart at 10 leaks"
+            )
+
+        # Force restart after threshold to prevent system audio issues
+        if abandoned_streams >= MAX_ABANDONED_STREAMS:
+            # Use notification instead of alert (non-blocking, safe from background thread)
+            rumps.notification(
+                title="Dictation - Restart Required",
+                subtitle=f"{abandoned_streams} streams leaked",
+                message="App will quit in 3 seconds to free resources. Please relaunch."
+            )
+            logging.critical(f"Reached {abandoned_streams} leaked streams - forcing quit")
+            time.sleep(3)  # Give user time to see notification
+            exit_now(1)
+
+        return False
+
+def post_command(msg):
+    """
+    Queue a message for state_manager (safe from any thread).
+
+    deque.append is atomic under the GIL, so producers take no lock - the
+    event only wakes the consumer.
+    """
+    command_queue.append(msg)
+    command_signal.set()
+
+def get_command():
+    """
+    Block until a message is queued, then return the oldest one.
+
+    Only state_manager calls this. The queue is re-checked after every
+    wake-up, so a message posted between wait() and clear() isn't lost.
+    """
+    while not command_queue:
+        command_signal.wait()
+        command_signal.clear()
+    return command_queue.popleft()
+
+def audio_callback(indata, frames, time, status):
+    """
+    Callback for audio recording (runs on sounddevice thread)
+
+    This is called ~100 times/second when audio stream is active.
+    Simply copies audio data into the recording ring and, every SEGMENT_SECONDS
+    of audio, tells the state manager a segment is ready to transcribe.
+
+    The stream is a RawInputStream, so indata is PortAudio's own buffer
+    rather than a numpy array built for each call; its bytes are copied
+    straight into the ring through a memoryview.
+
+    Safety net: Returns immediately if capture disabled to ensure callbacks
+    aren't active when we close the stream.
+
+    No lock and no allocation: this is the only writer, and it copies into
+    the preallocated ring before advancing recording_frames. The state
+    manager reads a recording_frames snapshot and only copies frames below
+    it (see read_ring), so it never sees a partial write.
+    """
+    global recording_frames
+
+    # Early return if capture disabled (safety net for stream close)
+    if not audio_capture_enabled.is_set():
+        return
+
+    # Byte copy into the ring, wrapping at its end - no temporary objects
+    ring = recording_ring_bytes
+    start = (recording_frames % RING_FRAMES) * FRAME_BYTES
+    end = start + frames * FRAME_BYTES
+    if end <= len(ring):
+        ring[start:end] = indata
+    else:
+        data = memoryview(indata)
+        split = len(ring) - start
+        ring[start:] = data[:split]
+        ring[:end - len(ring)] = data[split:]
+
+    # Publish only after the samples are in place
+    previous_frames = recording_frames
+    recording_frames += frames
+    # Crossed a segment boundary - state manager copies the segment out, we keep writing
+    if recording_frames // SEGMENT_FRAMES > previous_frames // SEGMENT_FRAMES:
+        post_command('SEGMENT_READY')
+
+def quietest_cut(audio):
+    """
+    Where to end a segment: the middle of the quietest SEGMENT_CUT_WINDOW in
+    its last SEGMENT_CUT_SEARCH_SECONDS.
+
+    A cut at exactly the boundary usually lands mid-word, leaving half a word
+    at the end of one transcription and the start of the next. Cutting in the
+    nearest pause keeps words whole on both sides.
+
+    Returns:
+        int: Number of frames of audio that belong to the finished segment
+    """
+    windows = min(len(audio), SEGMENT_CUT_SEARCH_SECONDS * SAMPLE_RATE) // SEGMENT_CUT_WINDOW
+    if windows < 2:
+        return len(audio)
+
+    search_start = len(audio) - windows * SEGMENT_CUT_WINDOW
+    blocks = audio[search_start:].reshape(windows, SEGMENT_CUT_WINDOW)
+    energy = np.einsum('ij,ij->i', blocks, blocks)  # Sum of squares per window, no squared temporary
+    return search_start + int(np.argmin(energy)) * SEGMENT_CUT_WINDOW + SEGMENT_CUT_WINDOW // 2
+
+def read_ring(start, end):
+    """
+    Copy frames [start, end) of the current recording out of the ring.
+
+    Returns a new array, so the transcription worker holds no reference into
+    the ring while the callback keeps writing.
+    """
+    if end - start > RING_FRAMES:
+        # Fell more than a ring behind - the oldest audio has been overwritten
+        logging.warning(f"Recording ring overrun - dropping {(end - start - RING_FRAMES) / SAMPLE_RATE:.1f}s of audio")
+        start = end - RING_FRAMES
+
+    offset = start % RING_FRAMES
+    length = end - start
+    if offset + length <= RING_FRAMES:
+        return recording_ring[offset:offset + length].copy()
+    return np.concatenate((recording_ring[offset:], recording_ring[:offset + length - RING_FRAMES]))
+
+def state_manager():
+    """
+    Main state machine - runs on dedicated thread.
+
+    Handles all state transitions in one place.
+    Purely event-driven - 0% CPU when blocked in get_command()
+
+    Supports parallel chunk recording: User can press Command again
+    while previous chunks are still transcribing. Chunks always type
+    in the order they were recorded, even if transcription finishes
+    out-of-order.
+
+    Long recordings are split about every SEGMENT_SECONDS, in a pause near
+    the boundary (see quietest_cut): each finished segment is transcribed
+    while the user keeps talking and becomes its own chunk, so only the
+    tail is left to transcribe on release.
+    """
+    global recording_ring, recording_ring_bytes, recording_frames, audio_capture_enabled, creation_failures
+    import sounddevice as sd  # Deferred from module level - loads PortAudio
+
+
+    # Local to this thread - no cross-thread races
+    audio_stream = None
+
+    # Recording state - track with simple flag, not complex state machine
+    is_recording = False
+    current_chunk_id = None  # ID of chunk currently being recorded
+    segment_start = 0        # Frame (recording_frames value) where the current chunk begins
+
+    # Sequencing: ensures chunks type in order
+    next_chunk_to_record = 0  # Next chunk ID to assign when recording starts
+    next_chunk_to_type = 0     # Next chunk ID that should be typed
+    pending_chunks = {}        # {chunk_id: text} - completed chunks waiting to type
+    continuation_chunks = set()  # Chunks that continue a segment mid-speech (need a joining space)
+
+    # Recordings: a long one is split into several chunks, but logged as a whole
+    recording_id = None   # First chunk ID of the recording in progress (identifies the recording)
+    recordings = {}       # {recording_id: {"chunks": [ids], "seconds": float, "texts": {id: text}, "open": bool, "split": bool}}
+    chunk_recording = {}  # {chunk_id: recording_id} - for chunks still transcribing
+
+    def try_type_pending_chunks():
+        """
+        Hand chunks to typing_worker in order. Returns True if any progress was made.
+        Stops at the first chunk that hasn't finished transcribing.
+        """
+        nonlocal next_chunk_to_type
+        made_progress = False
+
+        while next_chunk_to_type in pending_chunks:
+            chunk_text = pending_chunks.pop(next_chunk_to_type)
+
+            # Empty chunks just advance the sequence (this IS progress!)
+            if chunk_text:
+                type_queue.put((next_chunk_to_type, chunk_text))
+            made_progress = True
+            next_chunk_to_type += 1
+
+        return made_progress
+
+    def start_transcription(cid, audio):
+        """Queue a chunk for the transcription worker (posts CHUNK_DONE when finished)"""
+        recording = recordings[recording_id]
+        recording["chunks"].append(cid)
+        recording["seconds"] += len(audio) / SAMPLE_RATE
+        chunk_recording[cid] = recording_id
+
+        # Judge the recording, not the chunk - segments are always under 30s
+        long_recording = recording["split"] or recording["seconds"] > TRANSCRIPT_LOG_THRESHOLD
+        transcription_queue.put((cid, audio, long_recording))
+        logging.info(f"Transcription queued for chunk {cid}")
+
+    def finish_recording_chunk(cid, text):
+        """
+        Collect a transcribed chunk's text under its recording. Once a stopped
+        recording has all its chunks back, log it as one transcript with the
+        recording's total duration (segments alone never reach the threshold).
+        """
+        rid = chunk_recording.pop(cid, None)
+        recording = recordings.get(rid)
+        if recording is None:
+            return
+
+        recording["texts"][cid] = text
+        if recording["open"] or len(recording["texts"]) < len(recording["chunks"]):
+            return
+
+        del recordings[rid]
+        full_text = "".join(recording["texts"][c] for c in recording["chunks"]).strip()
+        log_long_transcript(recording["seconds"], full_text)
+
+    logging.info("State manager started (parallel chunk recording enabled)")
+
+    while True:
+        try:
+            # ALWAYS BLOCK - no timeouts, no polling!
+            # This is 0% CPU whether idle, recording, or transcribing
+            msg = get_command()
+            logging.debug(f"State manager received: {msg}")
+
+            # Handle COMMAND_DOWN
+            if msg == 'COMMAND_DOWN':
+                # Always allow recording, even if transcribing previous chunks!
+                # This enables natural chunking: press → release → press → release
+                if not is_recording:
+                    is_recording = True
+                    current_chunk_id = next_chunk_to_record
+                    next_chunk_to_record += 1
+                    recording_id = current_chunk_id
+                    recordings[recording_id] = {"chunks": [], "seconds": 0.0, "texts": {}, "open": True, "split": False}
+
+                    # Create fresh stream every time (ensures mic turns off between recordings)
+                    # Note: If previous stream was abandoned (deadlock), PortAudio might block here
+                    try:
+                        start_time = time.time()
+                        logging.info(f"Creating new audio stream for chunk {current_chunk_id}")
+
+                        # Create stream with a timeout to detect if PortAudio is blocked
+                        create_done = threading.Event()
+                        stream_ref = [None]  # List allows closure mutation (threading doesn't return values)
+                        error_ref = [None]
+
+                        # Rewind the ring BEFORE enabling capture (prevents race)
+                        if recording_ring is None:
+                            recording_ring = np.empty(RING_FRAMES, dtype=np.float32)
+                            recording_ring_bytes = memoryview(recording_ring).cast('B')
+                        recording_frames = 0
+                        segment_start = 0
+                        audio_capture_enabled.set()
+
+                        def try_create():
+                            try:
+                                # Create stream but don't start yet
+                                stream_ref[0] = sd.RawInputStream(
+                                    callback=audio_callback,
+                                    channels=CHANNELS,
+                                    samplerate=SAMPLE_RATE,
+                                    dtype='float32'  # Must match recording_ring
+                                )
+                                # Start stream - callbacks can now fire, but buffer is ready
+                                stream_ref[0].start()
+                            except Exception as e:
+                                error_ref[0] = e
+                            finally:
+                                create_done.set()
+
+                        threading.Thread(target=try_create, daemon=True, name="StreamCreate").start()
+
+                        if create_done.wait(timeout=2.0):
+                            if error_ref[0]:
+                                raise error_ref[0]
+                            audio_stream = stream_ref[0]
+                            creation_failures = 0  # Reset counter on success
+
+                            creation_time = time.time() - start_time
+                            logging.info(f"Recording started (chunk {current_chunk_id})")
+                            if creation_time > 0.1:  # Log if slow (>100ms)
+                                logging.warning(f"Stream creation latency: {creation_time:.3f}s")
+
+                            set_icon(_ICON_MIC)
+                        else:
+                            # Stream creation timed out - PortAudio blocked (likely by previous leak)
+                            creation_failures += 1
+                            logging.error(f"Stream creation timed out after 2s - PortAudio blocked (failure #{creation_failures})")
+
+                            # If stream was actually created (slow, not blocked), clean it up
+                            if stream_ref[0] is not None:
+                                logging.warning("Stream created after timeout - closing abandoned stream")
+                                close_stream_with_timeout(stream_ref[0], timeout=1.0)
+
+                            # After 3 failures, force restart (PortAudio is broken)
+                            if creation_failures >= 3:
+                                rumps.notification(
+                                    title="Dictation - Restart Required",
+                                    subtitle="Audio system blocked",
+                                    message="App will quit in 3 seconds. Please relaunch to fix audio."
+                                )
+                                logging.critical(f"Reached {creation_failures} creation failures - forcing quit")
+                                time.sleep(3)
+                                exit_now(1)
+                            else:
+                                rumps.notification(
+                                    title="Dictation - Audio Error",
+                                    subtitle="Cannot create audio stream",
+                                    message=f"Recording unavailable. Try quitting if this persists ({creation_failures}/3 failures)."
+                                )
+
+                            audio_stream = None
+                            is_recording = False
+                            audio_capture_enabled.clear()
+                            recordings.pop(recording_id, None)
+
+                    except Exception as e:
+                        logging.error(f"Failed to create/start audio stream: {e}")
+                        audio_stream = None
+                        is_recording = False
+                        audio_capture_enabled.clear()
+                        recordings.pop(recording_id, None)
+
+            # Handle COMMAND_UP
+            elif msg == 'COMMAND_UP':
+                if is_recording:
+                    # Stop recording, start transcription
+                    is_recording = False
+                    chunk_id = current_chunk_id
+                    current_chunk_id = None
+
+                    # STEP 1: Disable callbacks (safety net)
+                    audio_capture_enabled.clear()
+
+                    # STEP 2: Grab audio up to a write-index snapshot - no need to wait
+                    # out in-flight callbacks, since one still running only writes
+                    # past the snapshot (see audio_callback)
+                    recorded_audio = read_ring(segment_start, recording_frames)
+
+                    logging.info(f"Recording stopped (chunk {chunk_id}) - audio captured")
+
+                    # STEP 3: Close stream with timeout (turns off mic indicator)
+                    # PortAudio's close() can deadlock - use timeout wrapper to prevent hangs
+                    if audio_stream:
+                        success = close_stream_with_timeout(audio_stream, timeout=STREAM_CLOSE_TIMEOUT)
+                        if success:
+                            logging.info("Audio stream closed - mic indicator turned off")
+                        else:
+                            logging.warning("Stream close deadlocked - abandoned (will recreate fresh next time)")
+                        audio_stream = None  # Always discard handle, even if deadlocked
+
+                    # STEP 4: Continue with transcription
+                    set_icon(_ICON_THINKING)
+
+                    start_transcription(chunk_id, recorded_audio)
+                    recordings[recording_id]["open"] = False  # No more chunks - log once they're all back
+
+                elif pending_chunks and not is_recording:
+                    # User released Command and we have pending chunks - queue them for typing
+                    logging.debug("COMMAND_UP with pending chunks - attempting to type")
+                    if try_type_pending_chunks():
+                        set_icon(_ICON_MIC)
+                        logging.info(f"Queued pending chunks up to {next_chunk_to_type - 1} for typing")
+
+            # Handle SEGMENT_READY: recording crossed a segment boundary
+            elif msg == 'SEGMENT_READY':
+                # Stale if the recording already stopped - the audio went out with COMMAND_UP
+                if is_recording:
+                    # Snapshot the write index - the callback only ever writes past it
+                    segment_end = recording_frames
+                    audio = read_ring(segment_start, segment_end)
+
+                    # End the segment in the nearest pause; the audio after it starts the next chunk
+                    cut = quietest_cut(audio)
+                    segment_audio = audio[:cut]
+                    segment_start = segment_end - (len(audio) - cut)
+
+                    # Finished segment keeps the current ID; the rest of the recording gets the next one
+                    segment_id = current_chunk_id
+                    current_chunk_id = next_chunk_to_record
+                    next_chunk_to_record += 1
+                    continuation_chunks.add(current_chunk_id)
+
+                    logging.info(f"Segment boundary reached - chunk {segment_id} split off, recording continues as chunk {current_chunk_id}")
+                    recordings[recording_id]["split"] = True  # Already SEGMENT_SECONDS long - a long recording
+                    start_transcription(segment_id, segment_audio)
+
+            # Handle CHUNK_DONE: A transcription finished
+            elif isinstance(msg, tuple) and msg[0] == 'CHUNK_DONE':
+                chunk_id, text = msg[1], msg[2]
+
+                # Segments split a continuous recording - join with a space
+                if chunk_id in continuation_chunks:
+                    continuation_chunks.discard(chunk_id)
+                    if text:
+                        text = " " + text
+
+                # Store chunk (even if empty - needed for sequencing)
+                pending_chunks[chunk_id] = text
+                finish_recording_chunk(chunk_id, text)
+                logging.info(f"Chunk {chunk_id} transcription done (text length: {len(text)})")
+
+                # Type chunks in order if NOT actively recording
+                # This is state-based (deterministic), not racy physical check
+                if not is_recording:
+                    if try_type_pending_chunks():
+                        set_icon(_ICON_MIC)
+                        logging.info(f"Queued chunks up to {next_chunk_to_type - 1} for typing")
+                else:
+                    # Currently recording - defer typing to avoid interruption
+                    # Chunks will be typed when recording stops
+                    set_icon(_ICON_PAUSED)
+                    logging.info(f"Chunk {chunk_id} queued (is_recording={is_recording})")
+
+        except Exception as e:
+            logging.error(f"State manager error: {e}", exc_info=True)
+            # Reset recording state on errors but preserve pending chunks
+            if is_recording:
+                recordings.pop(recording_id, None)  # Its chunks still type, but the recording won't be logged
+            is_recording = False
+            current_chunk_id = None
+
+def transcription_timeout(duration_seconds):
+    """Timeout for transcribing audio of this length (2x duration, TRANSCRIPTION_TIMEOUT minimum)"""
+    return max(TRANSCRIPTION_TIMEOUT, int(duration_seconds * 2))
+
+def run_whisper(audio, duration_seconds, model_name=None, notify=True, **decode_options):
+    """
+    Run Whisper on float32 audio with timeout and retry handling.
+
+    Notifies the user on timeout or final failure (unless notify is False).
+    A timed-out call can't be interrupted (MLX has no cancellation hook), so
+    it keeps running on its executor thread - decode_options default to
+    settings that keep it from looping in the first place.
+
+    Args:
+        model_name: Model to run (defaults to current_model)
+
+    Returns:
+        dict: The mlx_whisper result, or None if transcription failed
+    """
+    timeout_seconds = transcription_timeout(duration_seconds)
+
+    # Conditioning each 30s window on the previous one's text is what lets a
+    # hallucinated phrase repeat until the timeout; dictation doesn't need it
+    decode_options.setdefault("condition_on_previous_text", False)
+
+    # Transcribe with timeout and retry logic
+    logging.info(f"Starting transcription (audio: {duration_seconds:.1f}s, timeout: {timeout_seconds}s)")
+
+    # Retry loop wraps only transcribe() call
+    for attempt in range(MAX_TRANSCRIPTION_RETRIES + 1):
+        try:
+            # Prepared inside the future so a first-time download or reload is covered by the timeout
+            future = transcription_executor.submit(
+                lambda a=audio, m=model_name or current_model: transcribe_with_model(a, m, **decode_options)
+            )
+            result = future.result(timeout=timeout_seconds)
+
+            if attempt > 0:
+                logging.info(f"Transcription succeeded on retry {attempt}")
+            return result
+
+        except FuturesTimeoutError:
+            # Timeout - don't retry, just fail
+            logging.error(f"Transcription timed out after {timeout_seconds}s")
+            if notify:
+                rumps.notification(
+                    title="Dictation",
+                    subtitle="Transcription timed out",
+                    message=f"Audio took too long to transcribe. Try a smaller/faster model."
+                )
+            future.cancel()
+            return None
+
+        except Exception as e:
+            # Capture error for potential retry
+            error_type = type(e).__name__
+
+            if attempt < MAX_TRANSCRIPTION_RETRIES:
+                # Retry on model/inference errors
+                logging.warning(f"Transcription attempt {attempt + 1} failed ({error_type}): {e}. Retrying...")
+                time.sleep(0.5)  # Brief delay before retry
+                continue
+            else:
+                # Final failure after all retries
+                logging.error(f"Transcription failed after {MAX_TRANSCRIPTION_RETRIES + 1} attempts ({error_type}): {e}", exc_info=True)
+                if notify:
+                    rumps.notification(
+                        title="Dictation",
+                        subtitle="Transcription failed",
+                        message=f"Error after {MAX_TRANSCRIPTION_RETRIES + 1} attempts: {error_type}. Try again or switch models."
+                    )
+                return None
+
+def log_long_transcript(duration_seconds, text):
+    """Append transcriptions longer than TRANSCRIPT_LOG_THRESHOLD to the transcript log"""
+    if duration_seconds > TRANSCRIPT_LOG_THRESHOLD and text:
+        transcript_log = os.path.expanduser('~/Library/Logs/Dictation_Transcripts.log')
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with open(transcript_log, 'a') as f:
+            f.write(f"\n{'='*80}\n")
+            f.write(f"[{timestamp}] Duration: {duration_seconds:.1f}s\n")
+            f.write(f"{text}\n")
+
+def notify_audio_error(e):
+    """Log and report a failure preparing audio (numpy operations)"""
+    error_type = type(e).__name__
+    logging.error(f"Audio processing error ({error_type}): {e}", exc_info=True)
+
+    # Notify user of the failure
+    rumps.notification(
+        title="Dictation",
+        subtitle="Audio processing failed",
+        message=f"Error: {error_type}. Check microphone and try again."
+    )
+
+def transcribe_recorded_audio(audio):
+    """
+    Transcribe recorded audio (runs on the transcription worker thread).
+
+    This is the actual Whisper transcription with timeout handling.
+
+    Returns:
+        (str, float): The transcribed text ("" on failure) and its
+        confidence (see average_logprob)
+    """
+    if len(audio) == 0:
+        logging.warning("No audio data captured")
+        return "", 0.0
+
+    try:
+        duration_seconds = len(audio) / SAMPLE_RATE
+        logging.debug(f"Audio combined: {duration_seconds:.1f}s")
+
+        # Whisper takes the float32 samples directly - no WAV file or ffmpeg decode
+        result = run_whisper(audio, duration_seconds)
+        if result is None:
+            return "", 0.0
+
+        text = result["text"].strip()
+        logging.info(f"Transcribed: '{text}'")
+        return text, average_logprob(result["segments"])
+
+    except Exception as e:
+        # Catch-all for audio preparation errors (numpy operations)
+        # Whisper errors are handled in run_whisper's retry loop
+        notify_audio_error(e)
+        return "", 0.0
+
+def may_contain_speech(chunk_id, audio):
+    """
+    Cheap gate before Whisper: is the chunk long and loud enough to hold speech?
+
+    Accidental Command taps and silent recordings otherwise cost a full
+    encoder pass. Chunks that fail are reported as empty text.
+    """
+    duration_seconds = len(audio) / SAMPLE_RATE
+    if duration_seconds < MIN_RECORDING_SECONDS:
+        logging.info(f"Chunk {chunk_id} too short to transcribe ({duration_seconds:.2f}s)")
+        return False
+
+    rms = np.sqrt(np.dot(audio, audio) / len(audio))  # One BLAS call, no squared temporary
+    if rms < SILENCE_RMS_THRESHOLD:
+        logging.info(f"Chunk {chunk_id} is silence (RMS {rms:.4f}) - not transcribing")
+        return False
+    return True
+
+def transcribe_batch(batch):
+    """
+    Transcribe several queued chunks with a single Whisper call.
+
+    Whisper pads every call out to a 30-second window, so five 2-second
+    chunks transcribed separately cost five full encoder passes. Here the
+    chunks are laid end to end with BATCH_GAP_SECONDS of silence between
+    them, transcribed once with word timestamps, and the words are split
+    back out by which chunk's time span they fall in.
+
+    Args:
+        batch: List of (chunk_id, audio, long_recording) in recording order
+
+    Returns:
+        list: (chunk_id, text, confidence) for every chunk in the batch
+    """
+    texts = {chunk_id: ("", 0.0) for chunk_id, _, _ in batch}
+    batch = [item for item in batch if may_contain_speech(item[0], item[1])]
+
+    if len(batch) == 1:
+        chunk_id, audio, _ = batch[0]
+        texts[chunk_id] = transcribe_recorded_audio(audio)
+    elif batch:
+        try:
+            # Lay chunks end to end, remembering where each one sits (in seconds)
+            gap = np.zeros(int(BATCH_GAP_SECONDS * SAMPLE_RATE), dtype=np.float32)
+            pieces = []
+            spans = []  # (chunk_id, start_seconds, end_seconds)
+            offset = 0
+            for chunk_id, audio, _ in batch:
+                spans.append((chunk_id, offset / SAMPLE_RATE, (offset + len(audio)) / SAMPLE_RATE))
+                pieces.extend((audio, gap))
+                offset += len(audio) + len(gap)
+            audio = np.concatenate(pieces)
+            duration_seconds = len(audio) / SAMPLE_RATE
+            logging.info(f"Batching {len(batch)} chunks into one transcription ({duration_seconds:.1f}s)")
+
+            result = run_whisper(audio, duration_seconds, word_timestamps=True)
+
+            if result is not None:
+                # Words (and segments, for confidence) belong to the chunk whose
+                # span (padded by half the gap) holds their midpoint
+                segments = result["segments"]
+                words = [word for segment in segments for word in segment.get("words", [])]
+                half_gap = BATCH_GAP_SECONDS / 2
+                for chunk_id, start, end in spans:
+                    text = "".join(
+                        word["word"] for word in words
+                        if start - half_gap <= (word["start"] + word["end"]) / 2 < end + half_gap
+                    ).strip()
+                    confidence = average_logprob([
+                        segment for segment in segments
+                        if start - half_gap <= (segment["start"] + segment["end"]) / 2 < end + half_gap
+                    ])
+                    texts[chunk_id] = (text, confidence)
+                    logging.info(f"Transcribed chunk {chunk_id}: '{text}'")
+
+        except Exception as e:
+            notify_audio_error(e)
+
+    return [(chunk_id, text, confidence) for chunk_id, (text, confidence) in texts.items()]
+
+def transcription_worker():
+    """
+    Transcribe queued chunks (runs on dedicated thread).
+
+    Blocks until a chunk is queued, then also takes everything else that
+    queued up in the meantime so a burst of short chunks shares one Whisper
+    call. Posts CHUNK_DONE for every chunk - state_manager handles ordering.
+
+    Low-confidence chunks of long recordings are held back and re-transcribed
+    together once recording stops (their text can't be typed before then
+    anyway), so the larger model is swapped in once per recording rather
+    than once per segment.
+    """
+    logging.info("Transcription worker started")
+    escalations = []  # (chunk_id, audio, text) waiting for retranscribe_with_larger_model
+
+    while True:
+        batch = [transcription_queue.get()]
+
+        # Recorded before the model finished loading - wait, then batch everything queued meanwhile
+        if not model_ready.is_set():
+            logging.info("Waiting for model to finish loading")
+            model_ready.wait()
+
+        while True:
+            try:
+                batch.append(transcription_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            results = transcribe_batch(batch)
+        except Exception as e:
+            logging.error(f"Transcription failed for chunks {[cid for cid, _, _ in batch]}: {e}")
+            results = [(cid, "", 0.0) for cid, _, _ in batch]
+
+        long_audio = {cid: audio for cid, audio, long_recording in batch if long_recording}
+        for cid, text, confidence in results:
+            # Long dictation the model wasn't sure about - worth a slower, larger model
+            if cid in long_audio and text and confidence < LOW_CONFIDENCE_LOGPROB:
+                logging.info(f"Low confidence transcription of chunk {cid} (avg logprob {confidence:.2f})")
+                escalations.append((cid, long_audio[cid], text))
+            else:
+                post_command(('CHUNK_DONE', cid, text))
+
+        # Recording stopped and its last chunk is done - escalate everything held back
+        if escalations and not audio_capture_enabled.is_set() and transcription_queue.empty():
+            for cid, text in retranscribe_with_larger_model(escalations):
+                post_command(('CHUNK_DONE', cid, text))
+            escalations = []
+
+def average_logprob(segments):
+    """Mean Whisper avg_logprob across segments (0.0 if there are none)"""
+    if not segments:
+        return 0.0
+    return sum(segment["avg_logprob"] for segment in segments) / len(segments)
+
+def retranscribe_with_larger_model(chunks):
+    """
+    Re-run low-confidence transcriptions with the next larger model.
+
+    Runs on the transcription thread before the chunks are reported done, so
+    the better text is what gets typed (typed text can't be revised
+    afterwards). Goes through run_whisper for the same retries and decode
+    options, then puts the current model (quantized, see prepare_model) back
+    in ModelHolder so the next dictation doesn't pay for the reload.
+
+    Only escalates to a model that's already downloaded - fetching hundreds
+    of MB (or GBs) here would hold up the user's text.
+
+    Args:
+        chunks: List of (chunk_id, audio, text)
+
+    Returns:
+        list: (chunk_id, text) - the larger model's text, or the original
+        text where it fails/times out
+    """
+    texts = [(cid, text) for cid, _, text in chunks]
+    model_name = current_model
+    index = VALID_MODELS.index(model_name)
+    if index + 1 >= len(VALID_MODELS):
+        return texts  # Already on the largest model
+
+    larger_model = VALID_MODELS[index + 1]
+    if resolve_model_path(larger_model, download=False) is None:
+        logging.info(f"{larger_model} model not downloaded - keeping original text")
+        return texts
+
+    logging.info(f"Re-transcribing {len(chunks)} chunk(s) with {larger_model} model")
+    for i, (cid, audio, text) in enumerate(chunks):
+        # Every model below large is English-only, so the user is dictating English -
+        # don't let the multilingual large model guess the language
+        result = run_whisper(audio, len(audio) / SAMPLE_RATE, model_name=larger_model, notify=False, language="en")
+        revised = result["text"].strip() if result is not None else ""
+        if revised:
+            logging.info(f"Re-transcribed chunk {cid}: '{revised}'")
+            texts[i] = (cid, revised)
+        else:
+            logging.warning(f"Re-transcription of chunk {cid} with {larger_model} failed - keeping original text")
+
+    try:
+        with _model_lock:
+            prepare_model(model_name)
+    except Exception as e:
+        # Not fatal - the next transcription loads it again
+        logging.warning(f"Failed to restore {model_name} model ({type(e).__name__}): {e}")
+
+    return texts
+
+def utf16_chunks(text, max_units=MAX_UNICODE_EVENT_LENGTH):
+    """
+    Split text into pieces of at most max_units UTF-16 code units.
+
+    CGEventKeyboardSetUnicodeString counts UTF-16 units, and characters
+    outside the BMP (most emoji) take two - a surrogate pair is never split.
+
+    Yields:
+        (str, int): The piece and its length in UTF-16 units
+    """
+    if len(text.encode('utf-16-le')) == 2 * len(text):
+        # Common case - every character is one unit, plain slicing works
+        for start in range(0, len(text), max_units):
+            chunk = text[start:start + max_units]
+            yield chunk, len(chunk)
+        return
+
+    chunk_start = 0
+    units = 0
+    for index, char in enumerate(text):
+        width = 2 if ord(char) > 0xFFFF else 1
+        if units + width > max_units:
+            yield text[chunk_start:index], units
+            chunk_start, units = index, 0
+        units += width
+    if units:
+        yield text[chunk_start:], units
+
+def type_text(text):
+    """
+    Type text by posting Unicode keyboard events (CGEvent).
+
+    Waits for Command to be released before typing to prevent shortcuts.
+    Sets typing_in_progress flag to block Right Command events during typing.
+
+    Returns:
+        True if text was typed successfully
+        False if Command still held after timeout (text should stay queued)
+    """
+    global typing_in_progress
+
+    if not text:
+        return True  # Empty text = success
+
+    # Wait for Command to be released (event tap signals the release - no polling).
+    # The final check-then-set below runs under _typing_lock, which closes the
+    # window where a press could slip in between them; key_event_callback
+    # still strips Right Command from our events as a second layer.
+    deadline = time.monotonic() + COMMAND_RELEASE_TIMEOUT
+    waiting = False
+    while is_command_physically_held():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.warning(f"Timeout waiting for Command release after {COMMAND_RELEASE_TIMEOUT * 1000:.0f}ms - deferring text")
+            return False  # Don't type, keep text queued
+        if not waiting:
+            logging.debug("Waiting for Command to be released before typing...")
+            waiting = True
+        if command_released_event.is_set():
+            # The tap hasn't seen this press (yet) - its event can't signal the
+            # release, so poll the hardware state for the rest of the grace period
+            time.sleep(min(remaining, 0.01))
+        else:
+            command_released_event.wait(timeout=remaining)
+
+    # Re-check and claim typing atomically: key_event_callback takes the same
+    # lock, so a Right Command press lands either before the check (we defer)
+    # or after the flag is set (the tap blocks it) - never in between.
+    with _typing_lock:
+        if is_command_physically_held():
+            logging.info("Right Command pressed before typing started - deferring text")
+            return False  # Don't type, keep text queued
+        typing_in_progress = True
+
+    try:
+        logging.info(f"Typing text: {len(text)} chars (Right Command blocked)")
+
+        # One key down/up pair carries up to MAX_UNICODE_EVENT_LENGTH UTF-16 units.
+        # Virtual key 0 is a placeholder - the Unicode string is what gets typed.
+        for chunk, length in utf16_chunks(text):
+            for key_down in (True, False):
+                key_event = CGEventCreateKeyboardEvent(None, 0, key_down)
+                CGEventKeyboardSetUnicodeString(key_event, length, chunk)
+                CGEventPost(kCGHIDEventTap, key_event)
+
+        logging.info("Text typed successfully")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to type text: {e}")
+        return False
+    finally:
+        # Always clear flag, even if typing failed
+        typing_in_progress = False
+        logging.debug("Typing completed, Right Command unblocked")
+
+
+def typing_worker():
+    """
+    Type transcribed chunks in order (runs on dedicated thread).
+
+    Keystroke injection blocks for as long as the text takes to type. Doing
+    it here keeps state_manager free to handle COMMAND_DOWN and CHUNK_DONE
+    meanwhile. If Command is still held, waits for its release and
+    retries the same chunk, so later chunks never overtake it.
+    """
+    logging.info("Typing worker started")
+
+    while True:
+        chunk_id, text = type_queue.get()
+
+        while True:
+            # Clear BEFORE trying, so a release during the attempt isn't missed
+            typing_resume.clear()
+            if type_text(text):
+                break
+            # Timeout - Command still held, wait for release
+            logging.info(f"Typing deferred at chunk {chunk_id} - will retry after Command release")
+            set_icon(_ICON_PAUSED)
+            typing_resume.wait()
+
+        logging.info(f"Typed chunk {chunk_id}")
+        if type_queue.empty():
+            set_icon(_ICON_MIC)
+
+def _classify(flags):
+    """
+    Classify Command state from event flags.
+
+    Returns:
+        (bool, bool): (any Command pressed, Left Command bit set).
+        Right Command is "pressed and not left".
+    """
+    return (flags & kCGEventFlagMaskCommand) != 0, (flags & kCGEventFlagMaskCommandLeft) != 0
+
+def _mark_command_released():
+    """Signal a Right Command release to type_text and a deferred typing_worker"""
+    command_released_event.set()
+    typing_resume.set()
+
+def _post_transition(transition):
+    """
+    Queue a COMMAND_DOWN/COMMAND_UP unless it repeats the last one queued.
+
+    A Right Command release consumed during typing never queues COMMAND_UP,
+    so the next press would otherwise queue a second COMMAND_DOWN for a
+    recording the state manager still has open. Only called from
+    key_event_callback (main run loop thread), so no lock is needed.
+    """
+    global _last_transition
+    if transition == _last_transition:
+        return
+    _last_transition = transition
+    post_command(transition)
+
+def key_event_callback(proxy, event_type, event, refcon):
+    """Callback for CGEvent tap - posts commands to queue and blocks Right Command during typing"""
+    global right_command_pressed, typing_in_progress
+
+    # Runs for every keystroke system-wide: only the Quartz calls can raise,
+    # so only they are guarded, and debug logging is skipped unless enabled.
+
+    # Two-layer defense against Command shortcuts during typing:
+    # 1. Strip flags from key events (handles Command already held BEFORE typing)
+    # 2. Block flag change events (prevents NEW Command presses during typing)
+
+    # Key events only matter while typing - an ordinary keystroke is one
+    # comparison and one flag test, never reaching the flags-changed logic
+    if event_type != kCGEventFlagsChanged:
+        # Layer 1: Strip Command flag from key events during typing
+        if typing_in_progress and event_type in _KEY_EVENT_TYPES:
+            try:
+                flags = CGEventGetFlags(event)
+                command_pressed, is_left = _classify(flags)
+                if command_pressed and not is_left:
+                    # Strip Command flag from the event
+                    CGEventSetFlags(event, flags & ~kCGEventFlagMaskCommand)
+                    if _DEBUG_LOGGING:
+                        logging.debug("Stripped Right Command flag from key event during typing")
+            except Exception as e:
+                logging.error(f"Error in key_event_callback: {e}")
+        return event  # Pass through (with modified flags if Right Command was stripped)
+
+    # Layer 2: Block Command flag changes during typing
+    try:
+        flags = CGEventGetFlags(event)
+    except Exception as e:
+        logging.error(f"Error in key_event_callback: {e}")
+        return event
+
+    command_pressed, is_left = _classify(flags)
+
+    # Left Command is a safety valve and never changes state - pass it straight
+    # through unless it hides a Right Command release we still have to act on
+    # (right_command_pressed is only written on this thread, so no lock needed)
+    if is_left and not right_command_pressed and command_released_event.is_set():
+        return event
+
+    right_cmd = command_pressed and not is_left
+
+    # Held for the typing_in_progress read and the state updates below, so a
+    # press is sequenced against type_text's check-then-set (see type_text)
+    with _typing_lock:
+        # Block Right Command during typing
+        # Left Command is NOT blocked - provides safety valve (Cmd+Q still works)
+        if typing_in_progress:
+            if right_cmd:
+                # Block Command press during typing (still physically down - next type_text must wait)
+                command_released_event.clear()
+                if _DEBUG_LOGGING:
+                    logging.debug("Blocked Right Command press during typing")
+                return None  # Consume the event
+            elif not command_pressed and right_command_pressed:
+                # Command was released during typing - consume but update state
+                if _DEBUG_LOGGING:
+                    logging.debug("Right Command released during typing (updating state)")
+                right_command_pressed = False
+                _mark_command_released()
+                return None  # Consume without sending COMMAND_UP
+
+        if right_cmd and not right_command_pressed:
+            right_command_pressed = True
+            command_released_event.clear()
+            _post_transition('COMMAND_DOWN')
+            return None  # Consume event
+
+        elif not right_cmd and right_command_pressed:
+            right_command_pressed = False
+            _mark_command_released()
+            _post_transition('COMMAND_UP')
+            return None  # Consume event
+
+        elif not right_cmd and not command_released_event.is_set():
+            # Release of a press that was blocked during typing - no COMMAND_UP,
+            # but a typing_worker deferred by it must still be woken
+            _mark_command_released()
+
+        elif not command_pressed:
+            # Any other Command release - a typing_worker deferred while it was
+            # held rechecks, rather than waiting for the next Right Command press
+            typing_resume.set()
+
+    return event  # Pass through other flag changes
+
+class DictationApp(rumps.App):
+    # Model submenu entries (model name, menu label), in menu order
+    _MODELS = (
+        ("tiny", "Tiny (fastest, lowest accuracy)"),
+        ("base", "Base (fast)"),
+        ("small", "Small (balanced)"),
+        ("medium", "Medium (slower, better)"),
+        ("large", "Large (slowest, best)"),
+    )
+
+    def __init__(self):
+        super(DictationApp, self).__init__(_ICON_MIC, quit_button=None)
+
+        # Load saved preferences
+        prefs = load_preferences()
+        apply_log_level(prefs.get("log_level"))
+        saved_model = prefs.get("model", DEFAULT_MODEL)
+
+        # Update globals with saved preferences
+        global current_model, quantize_preference
+        current_model = saved_model
+        quantize_preference = prefs.get("quantize")
+
+        # Create model selection submenu in one pass, marking the saved model as selected
+        # (load_preferences already validated it, so exactly one item matches)
+        self.model_menu = {}
+        for name, label in self._MODELS:
+            item = rumps.MenuItem(label, callback=self.change_model)
+            if name == saved_model:
+                item.state = True
+            self.model_menu[name] = item
+
+        self.menu = [
+            rumps.MenuItem("Status: Loading...", callback=None),
+            None,  # Separator
+            rumps.MenuItem("Hotkey: Right Command (hold)", callback=None),
+            None,
+            ["Model", list(self.model_menu.values())],
+            None,
+            rumps.MenuItem("Open Transcription Log", callback=self.open_transcript_log),
+            None,
+            "Quit"
+        ]
+
+        # Keep reference to event tap so it doesn't get garbage collected
+        self.event_tap = None
+
+        # Leak counter - only shown when leaks occur (created on demand)
+        self.leaked_streams_item = None
+
+        # Setup event tap first (on main thread)
+        self.setup_event_tap()
+
+        # Start loading in background
+        threading.Thread(target=self.init_app, daemon=True).start()
+
+    def change_model(self, sender):
+        """Change the Whisper model"""
+        # Note: Model switching is safe - the reload and any in-flight transcription
+        # take turns on _model_lock (see transcribe_with_model)
+
+        # Uncheck all models
+        for item in self.model_menu.values():
+            item.state = False
+
+        # Check the selected model
+        sender.state = True
+
+        # Extract model name from menu item title
+        model_name = sender.title.partition(' ')[0].lower()
+
+        logging.info(f"Switching to {model_name} model...")
+
+        # Save preference and reload model in background (keeps file I/O off the menu thread)
+        def reload():
+            # Merge so other saved preferences (e.g. quantize) survive the switch
+            save_preferences({**load_preferences(), "model": model_name})
+            load_model(model_name)
+            logging.info(f"Switched to {model_name} model")
+
+        threading.Thread(target=reload, daemon=True).start()
+
+    def open_transcript_log(self, _):
+        """Open the transcription log file in default text editor"""
+        transcript_log = os.path.expanduser('~/Library/Logs/Dictation_Transcripts.log')
+
+        # Create the file with a header if it's new - one open, no exists() check to race with
+        with open(transcript_log, 'a') as f:
+            if f.tell() == 0:
+                f.write(f"# Dictation Transcripts\n# Transcriptions longer than {TRANSCRIPT_LOG_THRESHOLD}s are logged here\n\n")
+
+        # Open in default editor (stdout is never read - stderr is only decoded on failure)
+        process = subprocess.Popen(
+            ['open', transcript_log],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        try:
+            _, stderr = process.communicate(timeout=OPEN_COMMAND_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            # open only hands off to LaunchServices - don't hold the menu thread for it
+            logging.warning(f"open did not return within {OPEN_COMMAND_TIMEOUT}s - not waiting for it")
+            # Reap it in the background so it doesn't linger as a zombie (communicate drains stderr too)
+            threading.Thread(target=process.communicate, daemon=True, name="OpenReaper").start()
+            return
+
+        if process.returncode != 0:
+            logging.error(f"Failed to open transcript log: {stderr.decode('utf-8', 'replace')}")
+            rumps.notification(
+                title="Dictation",
+                subtitle="Error opening log",
+                message="Could not open transcript log file"
+            )
+        else:
+            logging.info("Opened transcription log")
+
+    def setup_event_tap(self):
+        """Setup event tap on main thread (required for run loop)"""
+        logging.info("Starting keyboard event tap on main thread...")
+
+        # Create event tap for key down/up and modifier (flags changed) events
+        self.event_tap = CGEventTapCreate(
+            kCGSessionEventTap,
+            kCGHeadInsertEventTap,
+            kCGEventTapOptionDefault,
+            _EVENT_MASK,
+            key_event_callback,
+            None
+        )
+
+        if self.event_tap is None:
+            logging.error("Failed to create event tap! Need accessibility permissions.")
+        else:
+            # Create a run loop source and add it to the current run loop
+            run_loop_source = CFMachPortCreateRunLoopSource(None, self.event_tap, 0)
+            CFRunLoopAddSource(CFRunLoopGetCurrent(), run_loop_source, kCFRunLoopDefaultMode)
+            CGEventTapEnable(self.event_tap, True)
+            logging.info("Keyboard event tap started successfully on main thread")
+
+    def init_app(self):
+        """Initialize the app (start listeners, then load model)"""
+        # Stream will be created on-demand by state_manager (on first COMMAND_DOWN)
+        logging.info("Audio stream will be created on first recording")
+
+        # Start worker and state manager threads first, so the user can record
+        # while the model loads (transcription_worker waits for it)
+        threading.Thread(target=transcription_worker, daemon=True, name="TranscriptionWorker").start()
+        threading.Thread(target=typing_worker, daemon=True, name="TypingWorker").start()
+        threading.Thread(target=state_manager, daemon=True).start()
+        logging.info("State manager thread started")
+
+        # Load model
+        load_model()
+
+        # Update status
+        self.menu["Status: Loading..."].title = "Status: Ready"
+
+    @rumps.clicked("Quit")
+    def quit_app(self, _):
+        """Quit the app"""
+        logging.info("Quit requested")
+        exit_now(0)
+
+def main():
+    """Run the app (dictation.py calls this once it holds the single instance lock)"""
+    global app_instance
+    logging.info(f"Starting Dictation (PID: {os.getpid()})")
+    app_instance = DictationApp()
+    app_instance.run()
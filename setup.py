@@ -1,13 +1,21 @@
 """
 Setup script for creating standalone Dictation.app
 """
+import sys
 from setuptools import setup
 
+# A full (non-alias) build walks the whole dependency graph - numpy and MLX
+# nest deep enough to hit the default recursion limit in modulegraph
+sys.setrecursionlimit(5000)
+
 APP = ['dictation.py']
 DATA_FILES = []
 OPTIONS = {
     'argv_emulation': False,
-    'alias': True,  # Use alias mode to avoid recursion issues
+    'alias': False,  # Standalone bundle - alias mode resolves every import through the source tree at launch
+    'semi_standalone': False,
+    'compressed': True,  # Pure-Python modules in one site-packages.zip: one open instead of a stat per import
+    'optimize': 1,  # Strip asserts; not 2 - some dependencies format their own docstrings at import
     'iconfile': 'icon.icns',
     'plist': {
         'CFBundleName': 'Dictation',
@@ -16,10 +24,14 @@ OPTIONS = {
         'CFBundleVersion': '1.0.0',
         'CFBundleShortVersionString': '1.0.0',
         'LSUIElement': True,  # Run as background app (no dock icon)
+        'NSSupportsSuddenTermination': True,  # No state to save - logout/shutdown can kill us without asking
         'NSMicrophoneUsageDescription': 'Dictation needs microphone access to record your speech.',
     },
-    'packages': ['whisper', 'sounddevice', 'pyperclip', 'numpy', 'rumps', 'Quartz', 'Cocoa'],
-    'includes': ['_sounddevice_data', 'sounddevice', 'cffi', 'rumps', 'Quartz', 'Cocoa'],
+    'packages': ['mlx_whisper', 'mlx', 'sounddevice', 'numpy', 'rumps'],
+    # The PyObjC frameworks dictation_main.py and rumps import, not all of Cocoa
+    # (Quartz is its whole umbrella either way - any Quartz import runs Quartz/__init__)
+    'includes': ['dictation_main', '_sounddevice_data', 'sounddevice', 'cffi', 'rumps', 'Quartz', 'CoreFoundation', 'AppKit'],
+    'excludes': ['tkinter', 'test', 'pydoc_data'],
 }
 
 setup(